@@ -1,9 +1,302 @@
+import functools
+import glob
+import hashlib
 import os
+import tempfile
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import teotil2 as teo
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional. Fall back to NumPy
+    njit = None
+
+# Folder for Feather copies of input data. Owned by this project, so input
+# folders (e.g. the TEOTIL2 core data) are never written to
+CACHE_FOLD = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "cache"
+)
+
+# ID cols used for joining and grouping. These are never downcast
+KEY_COLS = ["regine", "regine_ned", "komnr", "vassom", "fylke_sone"]
+
+# ID cols with few unique values that are used for grouping. These are stored as
+# categoricals. 'fylke_sone' is not included, as it is only used to merge
+# frames whose categories would differ
+CAT_COLS = ["komnr", "vassom"]
+
+
+def _downcast_floats(df):
+    """Convert float64 cols to float32, except for the ID cols in KEY_COLS. Areas,
+       concentrations and coefficients do not need double precision, and halving
+       the column width makes the subsequent arithmetic faster.
+
+    Args:
+        df: Dataframe
+    Returns:
+        Dataframe
+    """
+    float_cols = df.select_dtypes("float64").columns.difference(KEY_COLS)
+
+    return df.astype({col: "float32" for col in float_cols})
+
+
+def _to_categorical(df):
+    """Convert the ID cols in CAT_COLS to categoricals, if present. These have only
+       a few hundred unique values and are repeatedly used for grouping and
+       lookups, which is faster on categoricals.
+
+    Args:
+        df: Dataframe
+    Returns:
+        Dataframe
+    """
+    return df.astype({col: "category" for col in CAT_COLS if col in df.columns})
+
+
+def _read_feather_mirror(src_path, read_func, key=""):
+    """Read a tabular data file via a Feather copy in CACHE_FOLD. Feather files are
+       much faster to read than CSV or Excel, so the copy is created the first
+       time it is needed and re-used on subsequent calls. The copy is named after
+       the original's modification time and size, so it is only re-used if both
+       match exactly; any change to the original (including replacing it with an
+       older file) creates a new copy. If the copy cannot be read or written (e.g.
+       the cache folder is not writable), the original file is read instead.
+
+    Args:
+        src_path:  Str. Path to original data file
+        read_func: Function. Called with 'src_path' to read the original file into
+                   a dataframe with a default index
+        key:       Str. Describes how 'read_func' reads the file e.g. the worksheet
+                   name or the args passed to pd.read_csv. Copies of the same file
+                   read in different ways are kept separate
+    Returns:
+        Dataframe
+    """
+    stat = os.stat(src_path)
+    digest = hashlib.sha1(repr((os.path.abspath(src_path), key)).encode("utf-8"))
+    prefix = "%s.%s" % (os.path.basename(src_path), digest.hexdigest()[:16])
+    mirror_path = os.path.join(
+        CACHE_FOLD, "%s.%d.%d.feather" % (prefix, stat.st_mtime_ns, stat.st_size)
+    )
+
+    try:
+        return pd.read_feather(mirror_path)
+    except (OSError, pa.ArrowException):
+        # Missing or unreadable copy. Rebuild below
+        pass
+
+    df = read_func(src_path)
+
+    # Write to a temp file and move it into place, so an interrupted write never
+    # leaves a truncated copy
+    tmp_path = None
+    try:
+        os.makedirs(CACHE_FOLD, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=CACHE_FOLD)
+        os.close(fd)
+        df.to_feather(tmp_path, compression="zstd")
+        os.replace(tmp_path, mirror_path)
+
+        # Remove copies of earlier versions of the original
+        for old_path in glob.glob(
+            os.path.join(CACHE_FOLD, glob.escape(prefix) + ".*.feather")
+        ):
+            if old_path != mirror_path:
+                os.remove(old_path)
+    except (OSError, pa.ArrowException):
+        pass
+    finally:
+        if tmp_path is not None and os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+    return df
+
+
+def _read_csv(csv_path, index_col=None, **kwargs):
+    """Read a CSV file via its Feather copy, with float cols downcast to float32
+       and ID cols as categoricals. See _read_feather_mirror(), _downcast_floats()
+       and _to_categorical().
+
+    Args:
+        csv_path:  Str. Path to CSV file
+        index_col: Int. Optional. Position of column to use as the index
+        kwargs:    Passed to pd.read_csv
+    Returns:
+        Dataframe
+    """
+    df = _read_feather_mirror(
+        csv_path, lambda p: pd.read_csv(p, **kwargs), repr(sorted(kwargs.items()))
+    )
+    df = _to_categorical(_downcast_floats(df))
+
+    if index_col is not None:
+        df = df.set_index(df.columns[index_col])
+
+    return df
+
+
+def _read_core_csv(core_fold, file_name, index_col=None, encoding=None):
+    """Read one of the core TEOTIL2 CSV files. These rarely change, so the parsed
+       file is cached and re-used e.g. when looping over years or land use
+       scenarios. The cache is keyed on the file's modification time and size,
+       which must match exactly, as for the Feather copies in
+       _read_feather_mirror(). Any change to the file means it is re-read.
+
+    Args:
+        core_fold: Str. Path to folder containing core TEOTIL2 data files
+        file_name: Str. Name of CSV file in 'core_fold'
+        index_col: Int. Optional. Position of column to use as the index
+        encoding:  Str. Optional. Encoding of CSV file
+    Returns:
+        Dataframe. A copy, so callers are free to modify it.
+    """
+    csv_path = os.path.join(core_fold, file_name)
+    stat = os.stat(csv_path)
+    df = _read_core_csv_cached(
+        csv_path, stat.st_mtime_ns, stat.st_size, index_col, encoding
+    )
+
+    return df.copy()
+
+
+@functools.lru_cache(maxsize=32)
+def _read_core_csv_cached(csv_path, mtime_ns, size, index_col, encoding):
+    """Cached reader used by _read_core_csv(). Do not modify the returned
+       dataframe, as it is shared between calls.
+
+    Args:
+        csv_path:  Str. Path to CSV file
+        mtime_ns:  Int. Modification time of 'csv_path' in ns. Only used as part
+                   of the cache key
+        size:      Int. Size of 'csv_path' in bytes. Only used as part of the
+                   cache key
+        index_col: Int or None. Position of column to use as the index
+        encoding:  Str or None. Encoding of CSV file
+    Returns:
+        Dataframe
+    """
+    return _read_csv(csv_path, index_col=index_col, sep=";", encoding=encoding)
+
+
+def _calc_loads_numpy(area, q_sp, coeffs, point):
+    """Calculate diffuse and aggregate loads for each regine and par. See
+       _calc_loads_numba() for a faster, compiled version of the same calculation.
+
+    Args:
+        area:   Array. Shape (regine, 5). Areas of wood, upland, lake, urban and
+                agri in km2
+        q_sp:   Array. Shape (regine,). Specific discharge in m3/s/km2
+        coeffs: Array. Shape (regine, par, 7). Coefficients for wood and upland
+                (mg/l), lake and urban (kg/km2), and agri background, point and
+                diffuse (kg/km2)
+        point:  Array. Shape (regine, par, 4). Spr, aqu, ren and ind point
+                sources in tonnes
+    Returns:
+        Array of shape (regine, par, 11). Wood, upland, lake, urban, agri
+        background, agri point, agri diffuse, all point, natural diffuse,
+        anthropogenic diffuse and all sources loads in tonnes.
+    """
+    n_reg, n_par = coeffs.shape[:2]
+
+    # Areas for each source category. Agri is used for back, point and diffuse
+    area = area[:, [0, 1, 2, 3, 4, 4, 4]]
+
+    # Woodland and upland coefficients are concentrations (mg/l), so scale by
+    # annual runoff (0.0864 * 365 = 31.536). Others are in kg/km2
+    scale = np.full(area.shape, 1e-3, dtype=area.dtype)
+    scale[:, :2] = q_sp[:, None] * 31.536
+    area = area * scale
+
+    loads = np.empty((n_reg, n_par, 11), dtype=area.dtype)
+
+    # Diffuse inputs
+    loads[:, :, :7] = coeffs * area[:, None, :]
+
+    # Aggregate values
+    # All point sources (incl. agri point)
+    loads[:, :, 7] = point.sum(axis=2) + loads[:, :, 5]
+
+    # Natural diffuse sources (wood, upland, lake and agri background)
+    loads[:, :, 8] = loads[:, :, [0, 1, 2, 4]].sum(axis=2)
+
+    # Anthropogenic diffuse sources (urban and agri diffuse)
+    loads[:, :, 9] = loads[:, :, 3] + loads[:, :, 6]
+
+    # All sources
+    loads[:, :, 10] = loads[:, :, 7:10].sum(axis=2)
+
+    return loads
+
+
+def _calc_loads_numba(area, q_sp, coeffs, point):
+    """Compiled version of _calc_loads_numpy(), used if numba is available. Loops
+       over regines in parallel and calculates all loads for each regine in one
+       pass, without the temporary arrays needed by NumPy.
+
+    Args:
+        See _calc_loads_numpy()
+    Returns:
+        See _calc_loads_numpy()
+    """
+    n_reg, n_par = coeffs.shape[0], coeffs.shape[1]
+    loads = np.empty((n_reg, n_par, 11), dtype=area.dtype)
+    for i in prange(n_reg):
+        # Woodland and upland coefficients are concentrations (mg/l), so scale
+        # by annual runoff (0.0864 * 365 = 31.536). Others are in kg/km2
+        runoff = q_sp[i] * 31.536
+        a_wood = area[i, 0] * runoff
+        a_upland = area[i, 1] * runoff
+        a_lake = area[i, 2] * 1e-3
+        a_urban = area[i, 3] * 1e-3
+        a_agri = area[i, 4] * 1e-3
+
+        for j in range(n_par):
+            # Diffuse inputs
+            wood = a_wood * coeffs[i, j, 0]
+            upland = a_upland * coeffs[i, j, 1]
+            lake = a_lake * coeffs[i, j, 2]
+            urban = a_urban * coeffs[i, j, 3]
+            agri_back = a_agri * coeffs[i, j, 4]
+            agri_pt = a_agri * coeffs[i, j, 5]
+            agri_diff = a_agri * coeffs[i, j, 6]
+
+            # Aggregate values
+            all_point = (
+                point[i, j, 0] + point[i, j, 1] + point[i, j, 2] + point[i, j, 3]
+            ) + agri_pt
+            nat_diff = wood + upland + lake + agri_back
+            anth_diff = urban + agri_diff
+
+            loads[i, j, 0] = wood
+            loads[i, j, 1] = upland
+            loads[i, j, 2] = lake
+            loads[i, j, 3] = urban
+            loads[i, j, 4] = agri_back
+            loads[i, j, 5] = agri_pt
+            loads[i, j, 6] = agri_diff
+            loads[i, j, 7] = all_point
+            loads[i, j, 8] = nat_diff
+            loads[i, j, 9] = anth_diff
+            loads[i, j, 10] = all_point + nat_diff + anth_diff
+
+    return loads
+
+
+# Use the compiled version if numba is available
+if njit is not None:
+    # Not full fastmath: NaN coefficients (e.g. missing fylke_sone) must propagate
+    # to the totals, as they do in _calc_loads_numpy()
+    _calc_loads = njit(
+        parallel=True, fastmath={"reassoc", "contract", "arcp"}, cache=True
+    )(_calc_loads_numba)
+else:
+    _calc_loads = _calc_loads_numpy
+
 
 def get_annual_agricultural_coefficients(xl_path, sheet_name, core_fold):
     """Get annual agricultural inputs from NIBIO and convert to land use coefficients.
@@ -18,29 +311,27 @@ def get_annual_agricultural_coefficients(xl_path, sheet_name, core_fold):
         Dataframe
     """
     # Read LU areas (same values used every year)
-    csv_path = os.path.join(core_fold, "fysone_land_areas.csv")
-    lu_areas = pd.read_csv(csv_path, sep=";", encoding="windows-1252")
+    lu_areas = _read_core_csv(
+        core_fold, "fysone_land_areas.csv", encoding="windows-1252"
+    )
 
     # Read NIBIO data
-    lu_lds = pd.read_excel(xl_path, sheet_name=sheet_name)
+    lu_lds = _read_feather_mirror(
+        xl_path, lambda p: pd.read_excel(p, sheet_name=sheet_name), sheet_name
+    )
 
-    # Join
-    lu_df = pd.merge(lu_lds, lu_areas, how="outer", on="omrade")
-
-    # Calculate required columns
-    # N
-    lu_df["agri_diff_tot-n_kg/km2"] = lu_df["n_diff_kg"] / lu_df["a_fy_agri_km2"]
-    lu_df["agri_point_tot-n_kg/km2"] = (
-        lu_df["n_point_kg"] / lu_df["a_fy_agri_km2"]
-    )  # Orig a_fy_eng_km2??
-    lu_df["agri_back_tot-n_kg/km2"] = lu_df["n_back_kg"] / lu_df["a_fy_agri_km2"]
-
-    # P
-    lu_df["agri_diff_tot-p_kg/km2"] = lu_df["p_diff_kg"] / lu_df["a_fy_agri_km2"]
-    lu_df["agri_point_tot-p_kg/km2"] = (
-        lu_df["p_point_kg"] / lu_df["a_fy_agri_km2"]
-    )  # Orig a_fy_eng_km2??
-    lu_df["agri_back_tot-p_kg/km2"] = lu_df["p_back_kg"] / lu_df["a_fy_agri_km2"]
+    # Join. Areas without NIBIO data get no coefficients either way, so only
+    # keep rows in 'lu_lds'
+    lu_df = pd.merge(lu_lds, lu_areas, how="left", on="omrade")
+
+    # Calculate required columns for N and P
+    # Orig a_fy_eng_km2 for 'point'??
+    new_cols = {}
+    for par in ["n", "p"]:
+        for typ in ["diff", "point", "back"]:
+            col = "agri_%s_tot-%s_kg/km2" % (typ, par)
+            new_cols[col] = lu_df["%s_%s_kg" % (par, typ)] / lu_df["a_fy_agri_km2"]
+    lu_df = lu_df.assign(**new_cols)
 
     # Get cols of interest
     cols = [
@@ -62,7 +353,7 @@ def get_annual_agricultural_coefficients(xl_path, sheet_name, core_fold):
 
 
 def make_rid_input_file(
-    year, engine, core_fold, out_csv, xl_path, sheet_name, par_list=["Tot-N", "Tot-P"]
+    year, engine, core_fold, out_path, xl_path, sheet_name, par_list=["Tot-N", "Tot-P"]
 ):
     """Builds a TEOTIL2 input file for the RID programme for the specified year.
        Modified to read agricultural coefficients from an Excel file, rather than
@@ -73,14 +364,18 @@ def make_rid_input_file(
         year:       Int. Year of interest
         par_list:   List. Parameters defined in
                     RESA2.RID_PUNKTKILDER_OUTPAR_DEF
-        out_csv:    Str. Path for output CSV file
+        out_path:   Str. Path for output file. The format is chosen from the file
+                    extension: '.parquet', '.feather' or '.arrow' for the
+                    binary formats, otherwise CSV. The TEOTIL2 model requires
+                    CSV, but the binary formats are much faster for other
+                    readers, which can also load just the cols they need
         core_fold:  Str. Path to folder containing core TEOTIL2 data files
         engine:     SQL-Alchemy 'engine' object already connected
                     to RESA2
         xl_path:    Str. Path to Excel file with NIBIO land cover data
         sheet_name: Str. Name of Excel worksheet in NIBIO file
     Returns:
-        Dataframe. The CSV is written to the specified path.
+        Dataframe. The output file is written to the specified path.
     """
 
     # Read data from RESA2
@@ -98,34 +393,26 @@ def make_rid_input_file(
     # Changes to kommuner boundaries in 2017 require different files for
     # different years
     if year < 2017:
-        csv_path = os.path.join(core_fold, "regine_pre_2017.csv")
-        reg_df = pd.read_csv(csv_path, index_col=0, sep=";")
+        reg_df = _read_core_csv(core_fold, "regine_pre_2017.csv", index_col=0)
     elif year == 2017:
-        csv_path = os.path.join(core_fold, "regine_2017.csv")
-        reg_df = pd.read_csv(csv_path, index_col=0, sep=";")
+        reg_df = _read_core_csv(core_fold, "regine_2017.csv", index_col=0)
     else:
-        csv_path = os.path.join(core_fold, "regine_2018_onwards.csv")
-        reg_df = pd.read_csv(csv_path, index_col=0, sep=";")
+        reg_df = _read_core_csv(core_fold, "regine_2018_onwards.csv", index_col=0)
 
     # 2. Retention factors
-    csv_path = os.path.join(core_fold, "retention_nutrients.csv")
-    ret_df = pd.read_csv(csv_path, sep=";")
+    ret_df = _read_core_csv(core_fold, "retention_nutrients.csv")
 
     # 3. Land cover
-    csv_path = os.path.join(core_fold, "land_cover.csv")
-    lc_df = pd.read_csv(csv_path, index_col=0, sep=";")
+    lc_df = _read_core_csv(core_fold, "land_cover.csv", index_col=0)
 
     # 4. Lake areas
-    csv_path = os.path.join(core_fold, "lake_areas.csv")
-    la_df = pd.read_csv(csv_path, index_col=0, sep=";")
+    la_df = _read_core_csv(core_fold, "lake_areas.csv", index_col=0)
 
     # 5. Background coefficients
-    csv_path = os.path.join(core_fold, "back_coeffs.csv")
-    back_df = pd.read_csv(csv_path, sep=";")
+    back_df = _read_core_csv(core_fold, "back_coeffs.csv")
 
     # 7. Fylke-Sone
-    csv_path = os.path.join(core_fold, "regine_fysone.csv")
-    fy_df = pd.read_csv(csv_path, sep=";")
+    fy_df = _read_core_csv(core_fold, "regine_fysone.csv")
 
     # Convert par_list to lower case
     par_list = [i.lower() for i in par_list]
@@ -134,32 +421,16 @@ def make_rid_input_file(
     # 1. Land use
     # 1.1 Land areas
     # Join lu datasets
-    area_df = pd.concat([reg_df, lc_df, la_df], axis=1, sort=True)
+    area_df = pd.concat([reg_df, lc_df, la_df], axis=1, sort=False)
     area_df.index.name = "regine"
     area_df.reset_index(inplace=True)
 
-    # Fill NaN
-    area_df.fillna(value=0, inplace=True)
+    # Fill NaN in numeric cols. 'regine_ned' is also set to 0 for regines with
+    # nothing downstream, so that they are kept in the output
+    fill_cols = list(area_df.select_dtypes("number").columns) + ["regine_ned"]
+    area_df.fillna(value={col: 0 for col in fill_cols}, inplace=True)
 
     # Get total area of categories
-    area_df["a_sum"] = (
-        area_df["a_wood_km2"]
-        + area_df["a_agri_km2"]
-        + area_df["a_upland_km2"]
-        + area_df["a_glacier_km2"]
-        + area_df["a_urban_km2"]
-        + area_df["a_sea_km2"]
-        + area_df["a_lake_km2"]
-    )
-
-    # If total exceeds overall area, calc correction factor
-    area_df["a_cor_fac"] = np.where(
-        area_df["a_sum"] > area_df["a_reg_km2"],
-        area_df["a_reg_km2"] / area_df["a_sum"],
-        1,
-    )
-
-    # Apply correction factor
     area_cols = [
         "a_wood_km2",
         "a_agri_km2",
@@ -168,23 +439,34 @@ def make_rid_input_file(
         "a_urban_km2",
         "a_sea_km2",
         "a_lake_km2",
-        "a_sum",
     ]
+    areas = area_df[area_cols].to_numpy()
+    a_sum = areas.sum(axis=1)
+    a_reg = area_df["a_reg_km2"].to_numpy()
 
-    for col in area_cols:
-        area_df[col] = area_df[col] * area_df["a_cor_fac"]
+    # If total exceeds overall area, calc correction factor
+    a_cor_fac = np.minimum(
+        1, np.divide(a_reg, a_sum, out=np.ones_like(a_sum), where=a_sum > 0)
+    )
+
+    # Apply correction factor
+    areas = areas * a_cor_fac[:, None]
+    a_sum = a_sum * a_cor_fac
+    new_cols = dict(zip(area_cols, areas.T))
 
     # Calc 'other' column
-    area_df["a_other_km2"] = area_df["a_reg_km2"] - area_df["a_sum"]
+    new_cols["a_other_km2"] = a_reg - a_sum
 
     # Combine 'glacier' and 'upland' as 'upland'
-    area_df["a_upland_km2"] = area_df["a_upland_km2"] + area_df["a_glacier_km2"]
+    new_cols["a_upland_km2"] = new_cols["a_upland_km2"] + new_cols.pop("a_glacier_km2")
 
     # Add 'land area' column
-    area_df["a_land_km2"] = area_df["a_reg_km2"] - area_df["a_sea_km2"]
+    new_cols["a_land_km2"] = a_reg - new_cols["a_sea_km2"]
 
-    # Tidy
-    del area_df["a_glacier_km2"], area_df["a_sum"], area_df["a_cor_fac"]
+    # Replace original area cols
+    area_df = area_df.drop(columns=area_cols).join(
+        pd.DataFrame(new_cols, index=area_df.index)
+    )
 
     # 1.2. Join background coeffs
     area_df = pd.merge(area_df, back_df, how="left", on="regine")
@@ -192,201 +474,146 @@ def make_rid_input_file(
     # 1.3. Join agri coeffs
     area_df = pd.merge(area_df, fy_df, how="left", on="regine")
     area_df = pd.merge(area_df, agri_df, how="left", on="fylke_sone")
+    area_df = _downcast_floats(area_df)
 
     # 2. Discharge
     # Sum LTA to vassom level
-    lta_df = area_df[["vassom", "q_reg_m3/s"]].groupby("vassom").sum().reset_index()
-    lta_df.columns = ["vassom", "q_lta_m3/s"]
+    q_lta = area_df.groupby("vassom", observed=True)["q_reg_m3/s"].transform("sum")
 
-    # Join
-    q_df = pd.merge(lta_df, q_df, how="left", on="vassom")
+    # Get mean flow for this year
+    # Mapping a categorical can return a categorical, so convert to float
+    q_yr = (
+        area_df["vassom"].map(q_df.set_index("vassom")["q_yr_m3/s"]).astype("float32")
+    )
 
     # Calculate corr fac
-    q_df["q_fac"] = q_df["q_yr_m3/s"] / q_df["q_lta_m3/s"]
-
-    # Join and reset index
-    df = pd.merge(area_df, q_df, how="left", on="vassom")
-    df.index = df["regine"]
-    del df["regine"]
+    q_fac = q_yr / q_lta
 
     # Calculate regine-specific flow for this year
-    for col in ["q_sp_m3/s/km2", "runoff_mm/yr", "q_reg_m3/s"]:
-        df[col] = df[col] * df["q_fac"]
-
-        # Fill NaN
-        df[col].fillna(value=0, inplace=True)
-
-    # Tidy
-    del df["q_fac"], df["q_yr_m3/s"], df["q_lta_m3/s"]
+    q_cols = ["q_sp_m3/s/km2", "runoff_mm/yr", "q_reg_m3/s"]
+    area_df[q_cols] = area_df[q_cols].mul(q_fac, axis=0).fillna(value=0)
 
     # 3. Point sources
     # 3.1. Aqu, ren, ind
-    # List of data to concat later
-    df_list = [
-        df,
+    # Join on regine
+    pt_list = [
+        _downcast_floats(pt_df).set_index("regine")
+        for pt_df in [aqu_df, ren_df, ind_df]
+        if pt_df is not None
     ]
-
-    # Set indices
-    for pt_df in [aqu_df, ren_df, ind_df]:
-        if pt_df is not None:
-            pt_df.index = pt_df["regine"]
-            del pt_df["regine"]
-            df_list.append(pt_df)
-
-    # Join
-    df = pd.concat(df_list, axis=1, sort=True)
-    df.index.name = "regine"
-    df.reset_index(inplace=True)
+    df = area_df.set_index("regine").join(pt_list, how="left").reset_index()
 
     # Fill NaN
-    for typ in ["aqu", "ren", "ind"]:
-        for par in par_list:
-            col = "%s_%s_tonnes" % (typ, par)
-            if col in df.columns:
-                df[col].fillna(value=0, inplace=True)
-            else:  # Create cols of zeros
-                df[col] = 0
+    pt_cols = [
+        "%s_%s_tonnes" % (typ, par) for typ in ["aqu", "ren", "ind"] for par in par_list
+    ]
+    df.fillna(value={col: 0 for col in pt_cols if col in df.columns}, inplace=True)
+
+    # Create cols of zeros
+    new_cols = {col: 0 for col in pt_cols if col not in df.columns}
+    df = df.join(pd.DataFrame(new_cols, index=df.index, dtype="float32"))
 
     # 3.2. Spr
     # Get total land area and area of cultivated land in each kommune
-    kom_df = df[["komnr", "a_land_km2", "a_agri_km2"]]
-    kom_df = kom_df.groupby("komnr").sum()
-    kom_df.reset_index(inplace=True)
-    kom_df.columns = ["komnr", "a_kom_km2", "a_agri_kom_km2"]
+    kom_grp = df.groupby("komnr", observed=True)
+    a_kom = kom_grp["a_land_km2"].transform("sum").to_numpy()
+    a_agri_kom = kom_grp["a_agri_km2"].transform("sum").to_numpy()
+
+    # Distribute loads over agri if the kommune has any, else over all land
+    use_agri = a_agri_kom > 0
+    reg_area = np.where(use_agri, df["a_agri_km2"], df["a_land_km2"])
+    kom_area = np.where(use_agri, a_agri_kom, a_kom)
+    reg_frac = np.divide(
+        reg_area, kom_area, out=np.zeros_like(reg_area), where=kom_area != 0
+    )
 
     if spr_df is not None:
-        # Join 'spredt' to kommune areas
-        kom_df = pd.merge(kom_df, spr_df, how="left", on="komnr")
-
-    else:  # Create cols of zeros
+        # Look up 'spredt' for each kommune
+        spr_df = spr_df.set_index("komnr")
+        new_cols = {}
         for par in par_list:
-            kom_df["spr_%s_tonnes" % par.lower()] = 0
+            col = "spr_%s_tonnes" % par
+            new_cols[col] = df["komnr"].map(spr_df[col]).astype("float32") * reg_frac
 
-    # Join back to main df
-    df = pd.merge(df, kom_df, how="left", on="komnr")
-
-    # Distribute loads
-    for par in par_list:
-        # Over agri
-        df["spr_agri"] = (
-            df["spr_%s_tonnes" % par] * df["a_agri_km2"] / df["a_agri_kom_km2"]
-        )
+    else:  # Create cols of zeros
+        new_cols = {"spr_%s_tonnes" % par: 0 for par in par_list}
 
-        # Over all area
-        df["spr_all"] = df["spr_%s_tonnes" % par] * df["a_land_km2"] / df["a_kom_km2"]
+    # Fill NaN and join
+    df = df.join(
+        pd.DataFrame(new_cols, index=df.index, dtype="float32").fillna(value=0)
+    )
 
-        # Use agri if > 0, else all
-        df["spr_%s_tonnes" % par] = np.where(
-            df["a_agri_kom_km2"] > 0, df["spr_agri"], df["spr_all"]
-        )
+    # 4. Diffuse and aggregate loads
+    # Loads are calculated for all pars at once on arrays with shape
+    # (regine, par, source) and added to 'df' in a single step
+    n_reg, n_par = len(df), len(par_list)
 
-    # Delete intermediate cols
-    del df["spr_agri"], df["spr_all"]
+    # Areas for each source category
+    area_cols = [
+        "a_wood_km2",
+        "a_upland_km2",
+        "a_lake_km2",
+        "a_urban_km2",
+        "a_agri_km2",
+    ]
+    area = df[area_cols].to_numpy()
+    q_sp = df["q_sp_m3/s/km2"].to_numpy()
+
+    # Coefficients for each par and source category
+    coeff_cols = [
+        "c_wood_mg/l_%s",
+        "c_upland_mg/l_%s",
+        "c_lake_kg/km2_%s",
+        "c_urban_kg/km2_%s",
+        "agri_back_%s_kg/km2",
+        "agri_point_%s_kg/km2",
+        "agri_diff_%s_kg/km2",
+    ]
+    coeffs = df[[col % par for par in par_list for col in coeff_cols]].to_numpy()
+    coeffs = coeffs.reshape(n_reg, n_par, len(coeff_cols))
+
+    # Point sources other than agriculture
+    point_cols = ["spr_%s_tonnes", "aqu_%s_tonnes", "ren_%s_tonnes", "ind_%s_tonnes"]
+    point = df[[col % par for par in par_list for col in point_cols]].to_numpy()
+    point = point.reshape(n_reg, n_par, len(point_cols))
+
+    # Output cols. Order must match _calc_loads_numpy()
+    load_cols = [
+        "wood_%s_tonnes",
+        "upland_%s_tonnes",
+        "lake_%s_tonnes",
+        "urban_%s_tonnes",
+        "agri_back_%s_tonnes",
+        "agri_pt_%s_tonnes",
+        "agri_diff_%s_tonnes",
+        "all_point_%s_tonnes",
+        "nat_diff_%s_tonnes",
+        "anth_diff_%s_tonnes",
+        "all_sources_%s_tonnes",
+    ]
+    loads = _calc_loads(area, q_sp, coeffs, point)
 
-    # Fill NaN
-    df["a_kom_km2"].fillna(value=0, inplace=True)
-    df["a_agri_kom_km2"].fillna(value=0, inplace=True)
-
-    for par in par_list:
-        # Fill
-        df["spr_%s_tonnes" % par].fillna(value=0, inplace=True)
-
-    # 4. Diffuse
-    # Loop over pars
-    for par in par_list:
-        # Background inputs
-        # Woodland
-        df["wood_%s_tonnes" % par] = (
-            df["a_wood_km2"]
-            * df["q_sp_m3/s/km2"]
-            * df["c_wood_mg/l_%s" % par]
-            * 0.0864
-            * 365
-        )
-
-        # Upland
-        df["upland_%s_tonnes" % par] = (
-            df["a_upland_km2"]
-            * df["q_sp_m3/s/km2"]
-            * df["c_upland_mg/l_%s" % par]
-            * 0.0864
-            * 365
-        )
-
-        # Lake
-        df["lake_%s_tonnes" % par] = (
-            df["a_lake_km2"] * df["c_lake_kg/km2_%s" % par] / 1000
-        )
-
-        # Urban
-        df["urban_%s_tonnes" % par] = (
-            df["a_urban_km2"] * df["c_urban_kg/km2_%s" % par] / 1000
-        )
-
-        # Agri from Bioforsk
-        # Background
-        df["agri_back_%s_tonnes" % par] = (
-            df["a_agri_km2"] * df["agri_back_%s_kg/km2" % par] / 1000
-        )
-
-        # Point
-        df["agri_pt_%s_tonnes" % par] = (
-            df["a_agri_km2"] * df["agri_point_%s_kg/km2" % par] / 1000
-        )
-
-        # Diffuse
-        df["agri_diff_%s_tonnes" % par] = (
-            df["a_agri_km2"] * df["agri_diff_%s_kg/km2" % par] / 1000
-        )
+    loads_df = pd.DataFrame(
+        loads.reshape(n_reg, -1),
+        columns=[col % par for par in par_list for col in load_cols],
+        index=df.index,
+    )
+    df = df.join(loads_df)
 
     # 5. Retention and transmission
     # Join
     df = pd.merge(df, ret_df, how="left", on="regine")
 
-    # Fill NaN
-    for par in par_list:
-        # Fill NaN
-        df["ret_%s" % par].fillna(value=0, inplace=True)
-
-        # Calculate transmission
-        df["trans_%s" % par] = 1 - df["ret_%s" % par]
-
-    # 6. Aggregate values
-    # Loop over pars
-    for par in par_list:
-        # All point sources
-        df["all_point_%s_tonnes" % par] = (
-            df["spr_%s_tonnes" % par]
-            + df["aqu_%s_tonnes" % par]
-            + df["ren_%s_tonnes" % par]
-            + df["ind_%s_tonnes" % par]
-            + df["agri_pt_%s_tonnes" % par]
-        )
-
-        # Natural diffuse sources
-        df["nat_diff_%s_tonnes" % par] = (
-            df["wood_%s_tonnes" % par]
-            + df["upland_%s_tonnes" % par]
-            + df["lake_%s_tonnes" % par]
-            + df["agri_back_%s_tonnes" % par]
-        )
-
-        # Anthropogenic diffuse sources
-        df["anth_diff_%s_tonnes" % par] = (
-            df["urban_%s_tonnes" % par] + df["agri_diff_%s_tonnes" % par]
-        )
-
-        # All sources
-        df["all_sources_%s_tonnes" % par] = (
-            df["all_point_%s_tonnes" % par]
-            + df["nat_diff_%s_tonnes" % par]
-            + df["anth_diff_%s_tonnes" % par]
-        )
-
-    # 7. Lake volume
+    # Calculate transmission, with NaN retention treated as 0
+    new_cols = {
+        "trans_%s" % par: 1 - df["ret_%s" % par].fillna(value=0) for par in par_list
+    }
+    df = df.join(pd.DataFrame(new_cols, index=df.index))
+
+    # 6. Lake volume
     # Estimate volume using poor relation from TEOTIL1
-    df["mean_lake_depth_m"] = 1.8 * df["a_lake_km2"] + 13
-    df["vol_lake_m3"] = df["mean_lake_depth_m"] * df["a_lake_km2"] * 1e6
+    mean_lake_depth_m = 1.8 * df["a_lake_km2"] + 13
+    df["vol_lake_m3"] = mean_lake_depth_m * df["a_lake_km2"] * 1e6
 
     # Get cols of interest
     # Basic_cols
@@ -422,21 +649,25 @@ def make_rid_input_file(
     ]
 
     # Build col list
-    for name in par_cols:
-        for par in par_list:
-            # Get col
-            col_list.append(name % par)
+    col_list += [name % par for name in par_cols for par in par_list]
 
-    # Get cols
-    df = df[col_list]
+    # Get cols of interest for rows where regine_ned is not null and fill NaN
+    df = df.loc[df["regine_ned"].notna(), col_list].fillna(value=0)
 
-    # Remove rows where regine_ned is null
-    df = df.query("regine_ned == regine_ned")
-
-    # Fill Nan
-    df.fillna(value=0, inplace=True)
+    # The joins above no longer sort by regine, so restore the original row order
+    df = df.sort_values("regine", ignore_index=True)
 
     # 7. Write output
-    df.to_csv(out_csv, encoding="utf-8", index=False)
+    # 'regine_ned' mixes str IDs with 0 for outlets, so must be cast to str
+    out_df = df.astype({"regine_ned": str})
+    ext = os.path.splitext(out_path)[1].lower()
+    if ext == ".parquet":
+        out_df.to_parquet(out_path, engine="pyarrow", compression="zstd")
+    elif ext in (".feather", ".arrow"):
+        out_df.to_feather(out_path, compression="zstd")
+    else:
+        # Use pyarrow's multi-threaded CSV writer, which is much faster than to_csv
+        tbl = pa.Table.from_pandas(out_df, preserve_index=False)
+        pa_csv.write_csv(tbl, out_path)
 
     return df